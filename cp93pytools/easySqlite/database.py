@@ -1,9 +1,14 @@
 from __future__ import annotations
 from pathlib import Path
-import sqlite3
+from contextlib import closing, nullcontext
+from itertools import count
+from operator import itemgetter
+from weakref import WeakValueDictionary
+import os, re, sqlite3, threading
 #from sqlite3.dbapi2 import ProgrammingError
-from typing import List, Any, Tuple, Union, cast
+from typing import FrozenSet, Iterable, List, Any, Set, Tuple, Union, cast
 from pathlib import Path
+from ..methodtools import cached_method
 from .types import (
     Data,
     Params,
@@ -11,6 +16,19 @@ from .types import (
 
 FilePath = Union[str, Path]
 
+# Live SqliteDB instances, see SqliteDB.__new__
+_instances: WeakValueDictionary[Tuple[type, str], SqliteDB]
+_instances = WeakValueDictionary()
+_instances_lock = threading.Lock()
+
+# Unique id for each thread connection, see SqliteDB.connection_version
+_connection_ids = count()
+
+# Connections inherited through fork(). SQLite forbids using them in the
+# child, and closing them could checkpoint the parent's WAL, so they are
+# kept here (never used, never closed)
+_inherited_connections: List[sqlite3.Connection] = []
+
 
 def custom_repr(self, *keys):
     name = self.__class__.__name__
@@ -22,30 +40,193 @@ class SqliteDB:
     '''
     '''
 
+    # Per-connection settings (journal_mode is persistent, set once)
+    pragmas = (
+        'PRAGMA synchronous=NORMAL',
+        'PRAGMA temp_store=MEMORY',
+        'PRAGMA cache_size=-64000',
+        'PRAGMA busy_timeout=5000',
+    )
+
+    # If True, dicts(), dict() and get_dict() return sqlite3.Row objects
+    # instead of dicts. They are faster to build and support row['column'],
+    # but iterating over them yields values, not keys.
+    row_factory_sqlite_row = False
+
+    def __new__(cls, file: FilePath):
+        '''
+        Returns the live instance for the same file if any, so that all
+        the tables of a file share the same per-thread connections.
+        In-memory databases are private to each instance.
+        '''
+        if str(file) in ('', ':memory:'):
+            return super().__new__(cls)
+        key = (cls, str(file))
+        with _instances_lock:
+            db = _instances.get(key)
+            if db is None:
+                db = _instances[key] = super().__new__(cls)
+        return db
+
     def __init__(self, file: FilePath):
+        if hasattr(self, '_tls'):
+            return  # Cached instance (already initialized)
         self.file = file
+        self._tls = threading.local()
+        if not self.in_memory():
+            with closing(sqlite3.connect(self.file)) as con:
+                con.execute('PRAGMA journal_mode=WAL')
 
     def __repr__(self):
         return custom_repr(self, 'file')
 
+    def __reduce__(self):
+        # Connections can not be pickled (nor shared across processes)
+        return (self.__class__, (self.file,))
+
+    def in_memory(self):
+        return str(self.file) in ('', ':memory:')
+
     def new_connection(self):
-        return sqlite3.connect(self.file, check_same_thread=False)
+        con = sqlite3.connect(self.file, check_same_thread=False)
+        for pragma in self.pragmas:
+            con.execute(pragma)
+        return con
+
+    def connection(self) -> sqlite3.Connection:
+        '''
+        Connection reused by all the queries of the current thread
+        (of the current process)
+        '''
+        con = getattr(self._tls, 'con', None)
+        if con is not None and self._tls.pid != os.getpid():
+            _inherited_connections.append(con)
+            con = None
+        if con is None:
+            con = self._tls.con = self.new_connection()
+            self._tls.pid = os.getpid()
+            self._tls.con_id = next(_connection_ids)
+        return con
+
+    def dedicated_connection(self):
+        '''
+        Context manager with a new connection, closed at exit.
+        In-memory databases use the thread connection instead,
+        because a new connection would open a different database.
+        '''
+        if self.in_memory():
+            return nullcontext(self.connection())
+        return closing(self.new_connection())
+
+    def connection_version(self) -> Tuple[int, int, int, int]:
+        '''
+        Changes whenever the database is modified, either by the current
+        thread connection (total_changes, schema_version for DDL) or by
+        others (data_version).
+        '''
+        con = self.connection()
+        versions = self.execute(
+            'SELECT * FROM PRAGMA_DATA_VERSION, PRAGMA_SCHEMA_VERSION')
+        data_version, schema_version = cast(Tuple[int, int], versions[0])
+        return (self._tls.con_id, con.total_changes, data_version,
+                schema_version)
 
     def _execute(self, query: str, params: Params = None) -> sqlite3.Cursor:
         assert not isinstance(params, str), f'Did you mean params=[{params}]?'
+        return self._run(query, params or [])
+
+    def _executemany(self, query: str,
+                     seq_of_params: Iterable[Params]) -> sqlite3.Cursor:
+        return self._run(query, seq_of_params, many=True)
+
+    def _run(self, query: str, params, many: bool = False,
+             fetch: bool = False):
+        con = self.connection()
         try:
-            with self.new_connection() as con:
-                return con.execute(query, params or [])
+            if many:
+                cursor = con.executemany(query, params)
+            else:
+                cursor = con.execute(query, params)
+            # Rows must be fetched before commiting (e.g. for RETURNING)
+            rows = cursor.fetchall() if fetch else None
+            if con.in_transaction:  # Writes open an implicit transaction
+                con.commit()
+            return rows if fetch else cursor
         except sqlite3.Error as e:
+            if con.in_transaction:
+                con.rollback()
             e.args = (*e.args, query, params)
             raise e
 
     def execute(self, query: str, params: Params = None) -> List[List[Data]]:
-        return [*self._execute(query, params or [])]
+        assert not isinstance(params, str), f'Did you mean params=[{params}]?'
+        rows = self._run(query, params or [], fetch=True)
+        return cast(List[List[Data]], rows)
 
     def execute_column(self, query: str, params: Params = None) -> List[Data]:
         rows = self.execute(query, params)
-        return [first for first, *_ in rows]
+        return [*map(itemgetter(0), rows)]
+
+    def upsert_info(self, table_name: str):
+        '''
+        Returns (unique_keys, required, checks, triggers) for the
+        given table, where
+            unique_keys are the sets of PRIMARY KEY or UNIQUE columns
+            required are the NOT NULL columns without default value
+            checks tells if the table has CHECK constraints
+            triggers tells if the table has triggers.
+        The result is cached until the schema changes.
+        '''
+        schema_version = self.execute('PRAGMA schema_version')[0][0]
+        return self._upsert_info(table_name, schema_version)
+
+    @cached_method()
+    def _upsert_info(self, table_name: str, schema_version: int):
+        info = self.execute(
+            '''
+            SELECT name, "notnull", dflt_value, pk
+            FROM PRAGMA_TABLE_INFO(?)
+            ''',
+            [table_name],
+        )
+        primary_key = frozenset(name for name, *_, pk in info if pk)
+        required = frozenset(name for name, notnull, default, _ in info
+                             if notnull and default is None)
+        index_columns = self.execute(
+            '''
+            SELECT il.name, ii.name
+            FROM PRAGMA_INDEX_LIST(?) AS il
+            JOIN PRAGMA_INDEX_INFO(il.name) AS ii
+            WHERE il."unique" AND NOT il.partial
+            ''',
+            [table_name],
+        )
+        indices = {}
+        for index, column in index_columns:
+            indices.setdefault(index, set()).add(column)
+        unique_keys = {
+            frozenset(columns)
+            for columns in [primary_key, *indices.values()]
+            if columns and None not in columns  # None: expression index
+        }
+        unique_keys = cast(Set[FrozenSet[str]], unique_keys)
+        required = cast(FrozenSet[str], required)
+        table_sql = self.execute_column(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+            [table_name],
+        )
+        checks = any(
+            re.search(r'\bCHECK\s*\(', str(sql), re.IGNORECASE)
+            for sql in table_sql)
+        n_triggers = self.execute_column(
+            '''
+            SELECT count(*) FROM sqlite_master
+            WHERE type = 'trigger' AND tbl_name = ?
+            ''',
+            [table_name],
+        )[0]
+        triggers = bool(n_triggers)
+        return unique_keys, required, checks, triggers
 
     def get_table(self, table_name: str):
         from .table import SqliteTable
@@ -1,7 +1,10 @@
 from __future__ import annotations
-from typing import Callable, Dict, Iterator, List, Any, Optional, Type, TypeVar, cast
-from functools import wraps
+from typing import Callable, Dict, Iterator, List, Any, Optional, Tuple, Type, TypeVar, cast
+from functools import lru_cache, wraps
+from itertools import chain
+from operator import itemgetter
 from random import shuffle
+import sqlite3
 from . import query_body as QB
 from .types import (DataRow, Data, Record, unzip)
 from .database import SqliteDB
@@ -26,6 +29,61 @@ def query_method(wrapped: F) -> F:
     return cast(F, wrapper)
 
 
+@lru_cache(maxsize=128)
+def _insert_query(verb: str, table: str, keys: Tuple[str, ...]):
+    columns = ', '.join(keys)
+    marks = ', '.join('?' for _ in keys)
+    return f'{verb} INTO {table} ({columns}) VALUES ({marks})'
+
+
+@lru_cache(maxsize=128)
+def _upsert_query(table: str, keys: Tuple[str, ...],
+                  key_columns: Tuple[str, ...]):
+    insert = _insert_query('INSERT', table, keys)
+    conflict = ', '.join(key_columns)
+    what = ', '.join(
+        f'{c} = excluded.{c}' for c in keys if c not in key_columns)
+    action = f'UPDATE SET {what}' if what else 'NOTHING'
+    return f'{insert} ON CONFLICT ({conflict}) DO {action}'
+
+
+@lru_cache(maxsize=128)
+def _set_query(keys: Tuple[str, ...]):
+    return ', '.join(f'{c} = ?' for c in keys)
+
+
+@lru_cache(maxsize=128)
+def _dict_maker(names: Tuple[str, ...]) -> Callable[[DataRow], Record]:
+    '''
+    Specialized function for converting rows into dicts. Equivalent to
+    lambda row: dict(zip(names, row)) but much faster (no zip, no loop).
+    '''
+    items = ', '.join(f'{name!r}: row[{i}]' for i, name in enumerate(names))
+    namespace = {}
+    exec(f'def to_dict(row): return {{{items}}}', namespace)
+    return namespace['to_dict']
+
+
+def _fetch_batches(db: SqliteDB, query: str, params: List[Data],
+                   batch_size: int, dicts: bool = False):
+    '''
+    Streams on a dedicated connection, closed when the iteration ends
+    (or the generator is closed). On the thread connection, the open
+    read snapshot would make the thread's writes fail as soon as any
+    other connection commits.
+    '''
+    with db.dedicated_connection() as con:
+        cursor = con.execute(query, params)
+        cursor.arraysize = batch_size
+        if dicts:
+            names = tuple(c for c, *_ in cursor.description)
+            to_dict = _dict_maker(names)
+        batch = cursor.fetchmany()
+        while batch:
+            yield [*map(to_dict, batch)] if dicts else batch
+            batch = cursor.fetchmany()
+
+
 class TableQuery:
 
     # Abstract attributes (defined by parents):
@@ -90,11 +148,16 @@ class TableQuery:
 
     @query_method
     def select(self, *columns: str):
+        query, params = self._select_query(*columns)
+        return self.db._execute(query, params)
+
+    @query_method
+    def _select_query(self, *columns: str):
         what = ', '.join(columns) or '*'
         params = []
         where = self._body._str(params)
         query = f'SELECT {what} FROM {self.name} {where}'
-        return self.db._execute(query, params)
+        return query, params
 
     @query_method
     def delete(self):
@@ -109,30 +172,63 @@ class TableQuery:
         #inst = 'INSERT OR IGNORE' if ignore else 'INSERT'
         where = self._body._str([]).strip()
         assert not where, f'Unexpected statements for INSERT: {where}'
-        table = self.name
         keys, values = unzip(record)
-        columns = ', '.join(keys)
-        marks = ', '.join('?' for _ in keys)
-        query = f'INSERT INTO {table} ({columns}) VALUES ({marks})'
+        query = _insert_query('INSERT', self.name, tuple(keys))
         return self.db._execute(query, values)
 
     @query_method
     def insert_or_ignore(self, **record: Data):
         where = self._body._str([]).strip()
         assert not where, f'Unexpected statements for INSERT: {where}'
-        table = self.name
         keys, values = unzip(record)
-        columns = ', '.join(keys)
-        marks = ', '.join('?' for _ in keys)
-        query = f'INSERT OR IGNORE INTO {table} ({columns}) VALUES ({marks})'
+        query = _insert_query('INSERT OR IGNORE', self.name, tuple(keys))
         cursor = self.db._execute(query, values)
         return cursor.rowcount
 
+    @query_method
+    def insert_dicts(self, dicts: List[Record]):
+        '''
+        Inserts many records in a single transaction.
+        All the records must have the same keys.
+        '''
+        where = self._body._str([]).strip()
+        assert not where, f'Unexpected statements for INSERT: {where}'
+        if not dicts:
+            return 0
+        keys = [*dicts[0]]
+        query = _insert_query('INSERT', self.name, tuple(keys))
+        cursor = self.db._executemany(query, self._dicts_params(keys, dicts))
+        return cursor.rowcount
+
+    @query_method
+    def upsert_dicts(self, dicts: List[Record], *key_columns: str):
+        '''
+        Inserts many records in a single transaction, updating
+        the existing ones. key_columns must be a UNIQUE or PRIMARY KEY
+        set of columns. All the records must have the same keys.
+        '''
+        where = self._body._str([]).strip()
+        assert not where, f'Unexpected statements for INSERT: {where}'
+        assert key_columns, 'You must specify the key columns explicitely'
+        if not dicts:
+            return 0
+        keys = [*dicts[0]]
+        query = _upsert_query(self.name, tuple(keys), key_columns)
+        cursor = self.db._executemany(query, self._dicts_params(keys, dicts))
+        return cursor.rowcount
+
+    @staticmethod
+    def _dicts_params(keys: List[str], dicts: List[Record]):
+        set_keys = set(keys)
+        for d in dicts:
+            assert set(d) == set_keys, f'Expected keys {keys}. Got {[*d]}'
+        return [[d[k] for k in keys] for d in dicts]
+
     @query_method
     def update_or_ignore(self, **partial_record: Data):
         QB.Where.assert_initialized(self._body._where)
         keys, params = unzip(partial_record)
-        what = ', '.join(f'{c} = ?' for c in keys)
+        what = _set_query(tuple(keys))
         where = self._body._str(params)
         query = f'UPDATE {self.name} SET {what} {where}'
         cursor = self.db._execute(query, params)
@@ -140,6 +236,16 @@ class TableQuery:
 
     @query_method
     def update(self, **partial_record: Data):
+        where = self._body._where
+        if isinstance(where, QB.WhereEqual) and self._can_upsert(
+                where.kwargs, partial_record):
+            # Single statement instead of update_or_ignore + insert
+            record = {**partial_record, **where.kwargs}
+            keys, values = unzip(record)
+            key_columns = tuple(where.kwargs)
+            query = _upsert_query(self.name, tuple(keys), key_columns)
+            self.db._execute(query, values)
+            return
         if not self.update_or_ignore(**partial_record):
             assert isinstance(
                 self._body._where, QB.WhereEqual
@@ -152,30 +258,53 @@ class TableQuery:
             self.insert(**record)
         return
 
+    def _can_upsert(self, where: Record, partial_record: Record):
+        '''
+        An upsert is equivalent to update_or_ignore + insert only if the
+        where columns are a UNIQUE key, they are not being modified,
+        the record provides all the NOT NULL columns, and the table has
+        no CHECK constraints (evaluated on the row to be inserted, even
+        if it conflicts) nor triggers (INSERT triggers would fire).
+        '''
+        if not where or not set(where).isdisjoint(partial_record):
+            return False
+        info = self.db.upsert_info(self.name)
+        unique_keys, required, checks, triggers = info
+        if checks or triggers:
+            return False
+        if frozenset(where) not in unique_keys:
+            return False
+        return required <= {*where, *partial_record}
+
     # high-level select methods
 
     @query_method
     def count(self):
+        limit = self._body._limit
         n = self.value('count(*)')
+        self._body._limit = limit  # Keep the query reusable (iter_ methods)
         return cast(int, n)
 
     # High-level methods with type argument
 
     @query_method
     def rows(self, *columns: str, type: Type = DataRow):
-        rows = [*self.select(*columns)]
+        rows = self.select(*columns).fetchall()
         return cast(List[type], rows)
 
     @query_method
     def dicts(self, *columns: str, type: Type = Record):
         cursor = self.select(*columns)
-        names = [c for c, *_ in cursor.description]
-        dicts = [dict(zip(names, row)) for row in cursor]
+        if self.db.row_factory_sqlite_row:
+            cursor.row_factory = sqlite3.Row
+            return cast(List[type], cursor.fetchall())
+        to_dict = _dict_maker(tuple(c for c, *_ in cursor.description))
+        dicts = [*map(to_dict, cursor)]
         return cast(List[type], dicts)
 
     @query_method
     def column(self, column: str, type: Type = Data):
-        values = [first for first, *_ in self.rows(column)]
+        values = [*map(itemgetter(0), self.rows(column))]
         return cast(List[type], values)
 
     @query_method
@@ -220,13 +349,13 @@ class TableQuery:
     @query_method
     def random_dicts(self, n: int, *columns: str, type: Type = Record):
         rows, keys = self._select_random(n, *columns)
-        dicts = [dict(zip(keys, row)) for row in rows]
+        dicts = [*map(_dict_maker(tuple(keys)), rows)]
         return cast(List[type], dicts)
 
     @query_method
     def random_values(self, n: int, column: str, type: Type = Data):
         rows = self.random_rows(n, column)
-        values = [first for first, *_ in rows]
+        values = [*map(itemgetter(0), rows)]
         return cast(List[type], values)
 
     @query_method
@@ -266,24 +395,43 @@ class TableQuery:
     # high-level iter_select methods
 
     @query_method
-    def iter_rows(self, *columns: str, type: Type = DataRow):
+    def iter_batches(self, *columns: str, batch_size: int = 1000,
+                     type: Type = DataRow):
+        '''
+        Iterates over lists of at most batch_size rows, fetched
+        with cursor.fetchmany() to keep memory usage bounded.
+        '''
         total_approx = self.count()
-        it = iter(self.select(*columns))
+        query, params = self._select_query(*columns)
+        it = _fetch_batches(self.db, query, params, batch_size)
+        it = cast(Iterator[List[type]], it)
+        return total_approx, it
+
+    @query_method
+    def iter_rows(self, *columns: str, batch_size: int = 1000,
+                  type: Type = DataRow):
+        total_approx, batches = self.iter_batches(*columns,
+                                                  batch_size=batch_size)
+        it = chain.from_iterable(batches)
         it = cast(Iterator[type], it)
         return total_approx, it
 
     @query_method
-    def iter_dicts(self, *columns: str, type: Type = Record):
+    def iter_dicts(self, *columns: str, batch_size: int = 1000,
+                   type: Type = Record):
         total_approx = self.count()
-        cursor = self.select(*columns)
-        names = [c for c, *_ in cursor.description]
-        it = (dict(zip(names, row)) for row in cursor)
+        query, params = self._select_query(*columns)
+        batches = _fetch_batches(self.db, query, params, batch_size,
+                                 dicts=True)
+        it = chain.from_iterable(batches)
         it = cast(Iterator[type], it)
         return total_approx, it
 
     @query_method
-    def iter_column(self, column: str, type: Type = Data):
-        total_approx = self.count()
-        it = iter(row[0] for row in self.select(column))
+    def iter_column(self, column: str, batch_size: int = 1000,
+                    type: Type = Data):
+        total_approx, batches = self.iter_batches(column,
+                                                  batch_size=batch_size)
+        it = map(itemgetter(0), chain.from_iterable(batches))
         it = cast(Iterator[type], it)
         return total_approx, it
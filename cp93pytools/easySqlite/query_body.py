@@ -1,5 +1,6 @@
 from __future__ import annotations
 from typing import List, Optional, Tuple
+from functools import lru_cache
 import abc
 from .types import (Params, Data, unzip)
 
@@ -69,11 +70,16 @@ class WhereEqual(WhereSql):
 
     def __init__(self, **kwargs: Data):
         keys, values = unzip(kwargs)
-        query = ' AND '.join(f'{k} = ?' for k in keys)
+        query = self._equal_query(tuple(keys))
         super().__init__(query, *values)
         # save also kwargs (only for update query):
         self.kwargs = kwargs
 
+    @staticmethod
+    @lru_cache(maxsize=128)
+    def _equal_query(keys: Tuple[str, ...]):
+        return ' AND '.join(f'{k} = ?' for k in keys)
+
 
 class WhereAnd(Where):
 
@@ -1,25 +1,104 @@
 from __future__ import annotations
-from typing import Any, Generic, List, Optional, Tuple, TypeVar, cast
+from typing import Any, Generic, Iterator, List, Optional, Sequence, Set, Tuple, TypeVar, cast
 from typing_extensions import Type, TypedDict, overload
 
-from contextlib import contextmanager
-import json, time, random, logging
+from contextlib import closing, contextmanager
+from functools import lru_cache
+import json, time, secrets, logging, sqlite3
 from .table import SqliteTable, FilePath
 
+try:
+    import orjson  # Optional, faster decoding (see SqliteStore.use_orjson)
+except ImportError:
+    orjson = None
+
 
 class StoreRecord(TypedDict):
     key: str
     value: Optional[str]
-    lock_token: float
+    lock_token: int
     locked_until: float
 
 
+STORE_COLUMNS = frozenset(StoreRecord.__annotations__)
+
+# (file, table name) pairs already created and checked by this process
+_validated: Set[Tuple[str, str]] = set()
+
+
+@lru_cache(maxsize=128)
+def _access_sql(table: str, n_keys: int):
+    # Compete with other processes for an exclusive update of all the keys.
+    # Single atomic statement: only the race winner gets rows back
+    values = ', '.join('(?)' for _ in range(n_keys))
+    return f'''
+        WITH requested(key) AS (VALUES {values})
+        INSERT INTO {table} (key, lock_token, locked_until)
+        SELECT key, ?, ? FROM requested WHERE true
+        ON CONFLICT (key) DO UPDATE SET
+            lock_token = excluded.lock_token,
+            locked_until = excluded.locked_until
+        WHERE
+            lock_token<0 OR
+            lock_token=excluded.lock_token OR
+            locked_until<?
+        RETURNING key, lock_token
+    '''
+
+
+def new_token() -> int:
+    # Positive (free locks have lock_token<0) and fits in a sqlite INTEGER
+    return secrets.randbits(63) or 1
+
+
 def create_deadline(timeout: Optional[float]):
     if timeout is None:
         return float('inf')
     return time.time() + timeout
 
 
+def json_loads(s: Optional[str], use_orjson: bool = False) -> Any:
+    '''
+    Empty strings and None are decoded as None.
+    With use_orjson, values written by json.dumps are decoded the same,
+    but faster: documents that orjson would decode differently
+    (long ints, NaN, Infinity) are left to json.
+    '''
+    if not s:
+        return None
+    if use_orjson and orjson is not None:
+        # orjson decodes ints out of the 64-bit range as floats.
+        # Cheaper than a regex: map digits to 0 and look for a long run
+        if s.translate(_digits_to_zero).find(_long_zeros) < 0:
+            try:
+                return orjson.loads(s)
+            except orjson.JSONDecodeError:  # e.g. NaN written by json.dumps
+                pass
+    return json.loads(s)
+
+
+_digits_to_zero = str.maketrans('123456789', '000000000')
+_long_zeros = '0' * 19
+
+
+def json_loads_many(encoded: List[Optional[str]],
+                    use_orjson: bool = False) -> List[Any]:
+    '''
+    Decodes many json strings with a single call to json_loads.
+    Empty strings and None are decoded as None.
+    '''
+    try:
+        joined = '[' + ','.join(s or 'null' for s in encoded) + ']'
+    except TypeError:  # Some value is not a str (e.g. a blob)
+        joined = None
+    if joined is not None:
+        decoded = json_loads(joined, use_orjson)
+        if len(decoded) == len(encoded):
+            return decoded
+    # Some value was not a single json document. Decode one by one
+    return [json_loads(s, use_orjson) for s in encoded]
+
+
 class TimeoutError(Exception):
     message = 'Waiting for access token timed out'
 
@@ -34,20 +113,73 @@ Data = TypeVar('Data')
 
 class SqliteStore(Generic[Value], SqliteTable):
 
+    # Decode values with orjson if installed (values are still encoded
+    # with json.dumps, and decoded exactly as json.loads would)
+    use_orjson = True
+
     def __init__(self, file: FilePath, name: str):
         self.table.__init__(file, name)
-        self.db.execute(f'''
-        CREATE TABLE IF NOT EXISTS {self.name}(
+        if (str(file), name) in _validated:
+            return
+        self.db.execute(self._create_query(self.name))
+        self._migrate_float_tokens()
+        wrong = STORE_COLUMNS.symmetric_difference(self.columns())
+        if wrong:  # Not an assert: must hold also under python -O
+            raise ValueError(f'Unexpected columns {self.columns()} in '
+                             f'{self.name}. Expected {set(STORE_COLUMNS)}')
+        if not self.db.in_memory():  # Each in-memory db is a new one
+            _validated.add((str(file), name))
+        return
+
+    @staticmethod
+    def _create_query(name: str):
+        return f'''
+        CREATE TABLE IF NOT EXISTS {name}(
             key text NOT NULL PRIMARY KEY,
             value text,
-            lock_token double NOT NULL,
+            lock_token INTEGER NOT NULL,
             locked_until double NOT NULL
         )
-        ''')
-        the_columns = {'key', 'value', 'lock_token', 'locked_until'}
-        assert set(self.columns()) == the_columns, self.columns()
+        '''
+
+    def _migrate_float_tokens(self):
+        '''
+        Tables created by older versions stored lock_token as double,
+        which can not hold the current 63-bit tokens. Such tables
+        are copied into a new one, releasing all the locks.
+        '''
+        con = self.db.connection()
+        if not self._has_float_tokens(con):
+            return
+        old = f'{self.name}__float_tokens'
+        try:
+            con.execute('BEGIN IMMEDIATE')
+            # Check again: other process may have migrated it meanwhile
+            if not self._has_float_tokens(con):
+                con.rollback()
+                return
+            con.execute(f'ALTER TABLE {self.name} RENAME TO {old}')
+            con.execute(self._create_query(self.name))
+            con.execute(f'''
+                INSERT INTO {self.name} (key, value, lock_token, locked_until)
+                SELECT key, value, -1, locked_until FROM {old}
+            ''')
+            con.execute(f'DROP TABLE {old}')
+            con.commit()
+        except sqlite3.Error:
+            if con.in_transaction:
+                con.rollback()
+            raise
+        self.invalidate_columns()
         return
 
+    def _has_float_tokens(self, con: sqlite3.Connection):
+        types = con.execute(
+            'SELECT name, type FROM PRAGMA_TABLE_INFO(?)',
+            [self.name],
+        ).fetchall()
+        return dict(types).get('lock_token', '').lower() == 'double'
+
     @property
     def table(self):
         return cast(SqliteTable, super())
@@ -60,7 +192,7 @@ class SqliteStore(Generic[Value], SqliteTable):
         d = cast(Optional[StoreRecord], d)
         if not d or not d['value']:
             raise KeyError(key)
-        value = json.loads(d['value'])
+        value = json_loads(d['value'], self.use_orjson)
         return cast(Value, value)
 
     @overload
@@ -87,14 +219,13 @@ class SqliteStore(Generic[Value], SqliteTable):
 
     def values(self):
         col = self.table.where_sql(
-            'value<>?',
-            None,
+            'value IS NOT NULL',
         ).column('value', type=str)
-        values = [json.loads(s) for s in col]
+        values = json_loads_many(col, self.use_orjson)
         return cast(List[Value], values)
 
     def keys(self):
-        return self.table.column('value', type=str)
+        return self.table.column('key', type=str)
 
     def items(self):
         encoded = self.table.rows(
@@ -102,10 +233,47 @@ class SqliteStore(Generic[Value], SqliteTable):
             'value',
             type=Tuple[str, Optional[str]],
         )
-        items = [(k, json.loads(v or 'null')) for k, v in encoded]
+        keys = [k for k, _ in encoded]
+        values = json_loads_many([v for _, v in encoded],
+                                 self.use_orjson)
+        items = [*zip(keys, values)]
         items = cast(List[Tuple[str, Value]], items)
         return items
 
+    def iter_keys(self, batch_size: int = 1000):
+        return self.table.iter_column(
+            'key',
+            batch_size=batch_size,
+            type=str,
+        )
+
+    def iter_values(self, batch_size: int = 1000):
+        total_approx, batches = self.table.where_sql(
+            'value IS NOT NULL',
+        ).iter_batches('value', batch_size=batch_size)
+        it = (
+            value for batch in batches
+            for value in json_loads_many([s for s, in batch],
+                                         self.use_orjson)
+        )
+        it = cast(Iterator[Value], it)
+        return total_approx, it
+
+    def iter_items(self, batch_size: int = 1000):
+        total_approx, batches = self.table.iter_batches(
+            'key',
+            'value',
+            batch_size=batch_size,
+        )
+        it = (
+            item for batch in batches for item in zip(
+                [k for k, _ in batch],
+                json_loads_many([v for _, v in batch], self.use_orjson),
+            )
+        )
+        it = cast(Iterator[Tuple[str, Value]], it)
+        return total_approx, it
+
     def __set_assuming_token(self, key: str, value: Value):
         return self.table.where(key=key).update(value=json.dumps(value))
 
@@ -119,7 +287,7 @@ class SqliteStore(Generic[Value], SqliteTable):
             type=StoreRecord,
         )
 
-    def set(self, key: str, value: Value, token: float):
+    def set(self, key: str, value: Value, token: int):
         '''
         Requires a token provided by the exclusive access context
         manager self.wait_token() or self.ask_token().
@@ -128,7 +296,7 @@ class SqliteStore(Generic[Value], SqliteTable):
             self.__set_assuming_token(key, value)
         return
 
-    def delete(self, key: str, token: float):
+    def delete(self, key: str, token: int):
         '''
         Requires a token provided by the exclusive access context
         manager self.wait_token() or self.ask_token().
@@ -191,12 +359,9 @@ class SqliteStore(Generic[Value], SqliteTable):
                 table.set('some_key', some_value, token)
         '''
         assert keys, 'You must specify keys to be locked explicitely'
-        token = random.random()
+        token = new_token()
         try:
-            gained_access = all([
-                self._ask_access(key, token=token, max_duration=max_duration)
-                for key in keys
-            ])
+            gained_access = self._ask_access(keys, token, max_duration)
             yield token if gained_access else None
         finally:
             for key in keys:
@@ -204,13 +369,13 @@ class SqliteStore(Generic[Value], SqliteTable):
         return
 
     @contextmanager
-    def assert_token(self, *keys: str, token: float):
+    def assert_token(self, *keys: str, token: int):
         assert keys, 'You must specify keys to be locked explicitely'
         max_duration = 0.5
         try:
             for key in keys:
                 if not self._ask_access(
-                        key,
+                        [key],
                         token=token,
                         max_duration=max_duration,
                 ):
@@ -241,46 +406,80 @@ class SqliteStore(Generic[Value], SqliteTable):
             current = table.set('some_key', some_value, token)
         '''
         assert keys, 'You must specify keys to be locked explicitely'
-        token = random.random()
+        token = new_token()
+        deadline = create_deadline(timeout)
         try:
-            for key in keys:
-                deadline = create_deadline(timeout)
-                while not self._ask_access(key, token, max_duration):
-                    if time.time() > deadline:
-                        raise TimeoutError(timeout)
-                    time.sleep(request_every)
+            while not self._wait_access(keys, token, max_duration, deadline):
+                if time.time() > deadline:
+                    raise TimeoutError(timeout)
+                time.sleep(request_every)
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e):
+                raise e
+            raise TimeoutError(timeout) from e
+        else:
             yield token
         finally:
             for key in keys:
                 self._unlock(key, token, max_duration)
         return
 
-    def _ask_access(self, key: str, token: float, max_duration: float):
+    def _ask_access(self, keys: Sequence[str], token: int,
+                    max_duration: float):
+        return self._try_access(self.db.connection(), keys, token,
+                                max_duration)
+
+    def _wait_access(self, keys: Sequence[str], token: int,
+                     max_duration: float, deadline: float):
+        '''
+        Same as _ask_access, but waits inside sqlite (busy_timeout)
+        until the deadline if the database is being written by others.
+        '''
+        con = self.db.connection()
+        previous, = con.execute('PRAGMA busy_timeout').fetchone()
+        remaining = min(max(0, deadline - time.time()), 86400)
+        con.execute(f'PRAGMA busy_timeout={int(remaining * 1000)}')
+        try:
+            return self._try_access(con, keys, token, max_duration)
+        finally:
+            con.execute(f'PRAGMA busy_timeout={previous}')
+
+    def _try_access(self, con: sqlite3.Connection, keys: Sequence[str],
+                    token: int, max_duration: float):
+        '''
+        Locks all the keys in a single transaction, or none of them.
+        '''
+        query, params = self._access_query(keys, token, max_duration)
+        try:
+            # Explicit: sqlite3 does not BEGIN implicitly for WITH statements
+            con.execute('BEGIN IMMEDIATE')
+            returned = con.execute(query, params).fetchall()
+        except sqlite3.Error:
+            if con.in_transaction:
+                con.rollback()
+            raise
+        gained_access = self._gained_access(returned, keys, token)
+        if gained_access:
+            con.commit()
+        else:
+            con.rollback()
+        return gained_access
+
+    def _access_query(self, keys: Sequence[str], token: int,
+                      max_duration: float):
+        keys = [*dict.fromkeys(keys)]  # Without repetitions
         now = time.time()
         until = now + max_duration
-        # Compete with other processes for an exclusive update
-        did = self.table.where(key=key).and_where_sql(
-            """
-            lock_token<0 OR
-            lock_token=? OR
-            locked_until<?
-            """,
-            token,
-            now,
-        ).update_or_ignore(
-            lock_token=token,
-            locked_until=until,
-        )
-        if did:  # Race winner
-            return True
-        # Maybe the key was not even present:
-        return self.insert_or_ignore(
-            key=key,
-            lock_token=token,
-            locked_until=until,
-        )
+        query = _access_sql(self.name, len(keys))
+        return query, [*keys, token, until, now]
 
-    def _unlock(self, key: str, token: float, max_duration: float):
+    @staticmethod
+    def _gained_access(returned: List[Tuple[str, int]], keys: Sequence[str],
+                       token: int):
+        mine = {key for key, lock_token in returned if lock_token == token}
+        return mine == set(keys)
+
+    def _unlock(self, key: str, token: int, max_duration: float):
         d = self._current_lock(key)
         if not d:
             # Entry was deleted (and unlocked)
@@ -294,3 +493,99 @@ class SqliteStore(Generic[Value], SqliteTable):
         if d['lock_token'] == token:
             self.table.where(key=key).update(lock_token=-1)
         return
+
+
+def test_json():
+    values = [
+        None, True, 0, -1.5, 'text', [1, [2, None]], {'a': {'b': 'c'}},
+        float('nan'), float('inf'), -float('inf'), 1e300, 0.1,
+        2**63 - 1, -2**63, 2**64 - 1, 2**64, -2**63 - 1, 2**70, -2**70,
+        [2**70, float('nan'), 'null'], {'big': -2**100}, '\ud800',
+        '1234567890123456789012', 'ñ 0123456789', {'x': 1.5e-7},
+    ]
+
+    def same(a, b):  # Like ==, but NaN equals NaN
+        return repr(a) == repr(b) and type(a) == type(b)
+
+    for use_orjson in [False, True]:
+        store = SqliteStore(':memory:', 'kv')
+        store.use_orjson = use_orjson
+        for i, value in enumerate(values):
+            store.wait_set(f'k{i:02}', value)
+            assert same(store[f'k{i:02}'], value), (use_orjson, value)
+        for (_, value), expected in zip(sorted(store.items()), values):
+            assert same(value, expected), (use_orjson, value)
+        for value, expected in zip(store.values(), values):
+            assert same(value, expected), (use_orjson, value)
+        encoded = [json.dumps(v) for v in values]
+        assert same(json_loads_many(encoded, use_orjson), values)
+    print('OK')
+
+
+def test_locks():
+    import os, tempfile, threading
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SqliteStore(os.path.join(tmp, 'locks.db'), 'kv')
+        other = SqliteStore(store.db.file, 'kv')
+        store.wait_set('b', 'B')
+
+        def lock_of(key: str):
+            d = store._current_lock(key)
+            return d and d['lock_token']
+
+        with store.ask_token('b', max_duration=2) as holder:
+            assert holder and lock_of('b') == holder
+            # All or nothing: 'a' is free but 'b' is not
+            with other.ask_token('a', 'b') as token:
+                assert token is None
+            assert lock_of('a') is None, 'Partial lock left on a'
+            assert lock_of('b') == holder
+            start = time.time()
+            try:
+                with other.wait_token('a', 'b', timeout=0.2):
+                    raise AssertionError('b is locked by holder')
+            except TimeoutError:
+                pass
+            assert 0.2 <= time.time() - start < 1
+            assert lock_of('a') is None, 'Partial lock left on a'
+            assert lock_of('b') == holder
+
+            result = {}
+
+            def waiter():
+                with other.wait_token('a', 'b', timeout=3) as token:
+                    result['locks'] = (token, lock_of('a'), lock_of('b'))
+
+            thread = threading.Thread(target=waiter)
+            thread.start()
+            time.sleep(0.2)
+            assert not result and lock_of('a') is None
+        thread.join()
+        token, lock_a, lock_b = result['locks']
+        assert token and lock_a == lock_b == token
+        assert lock_of('a') == lock_of('b') == -1
+        assert store['b'] == 'B'
+    print('OK')
+
+
+def test_len():
+    import os, tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        table = SqliteTable(os.path.join(tmp, 'len.db'), 't')
+        create = 'CREATE TABLE t(k int PRIMARY KEY)'
+        table.db.execute(create)
+        table.insert_dicts([{'k': k} for k in range(5)])
+        assert len(table) == 5
+        # Local writes
+        table.insert(k=5)
+        assert len(table) == table.count() == 6
+        # Writes of other connection
+        with closing(table.db.new_connection()) as con:
+            con.execute('DELETE FROM t WHERE k < 2')
+            con.commit()
+        assert len(table) == table.count() == 4
+        # Local DDL (total_changes and data_version do not change)
+        table.db.execute('DROP TABLE t')
+        table.db.execute(create)
+        assert len(table) == table.count() == 0
+    print('OK')
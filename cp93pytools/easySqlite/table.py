@@ -1,5 +1,5 @@
 from __future__ import annotations
-from typing import Dict, List, Optional, cast
+from typing import Dict, List, Optional, Tuple, cast
 from random import shuffle
 from .database import SqliteDB, FilePath, custom_repr
 from .query import TableQuery
@@ -28,21 +28,38 @@ class SqliteTable(TableQuery):
         self.file = file
         self.name = table_name
         self.db = SqliteDB(self.file)
+        self._columns: Optional[List[str]] = None
+        self._len_cache: Optional[Tuple[Tuple[int, ...], int]] = None
 
     def __repr__(self):
         return custom_repr(self, 'file', 'table_name')
 
     def __len__(self):
-        return self.count()
+        '''
+        Cached count(). The cache is invalidated by any write to the
+        database (see SqliteDB.connection_version).
+        Use count() to bypass it.
+        '''
+        version = self.db.connection_version()
+        if self._len_cache is None or self._len_cache[0] != version:
+            self._len_cache = (version, self.count())
+        return self._len_cache[1]
 
     def columns(self) -> List[str]:
-        query_str = 'SELECT name FROM PRAGMA_TABLE_INFO(?)'
-        column_names = self.db.execute_column(
-            query_str,
-            [self.name],
-        )
-        column_names = cast(List[str], column_names)
-        return column_names
+        if not self._columns:  # None, or not created yet
+            query_str = 'SELECT name FROM PRAGMA_TABLE_INFO(?)'
+            column_names = self.db.execute_column(
+                query_str,
+                [self.name],
+            )
+            self._columns = cast(List[str], column_names)
+        return [*self._columns]
+
+    def invalidate_columns(self):
+        '''
+        Forget the cached columns. Call it after altering the table schema.
+        '''
+        self._columns = None
 
 
 def test():
@@ -1,11 +1,26 @@
+import os
 import socket
+import sys
 from contextlib import closing
 
 
-# https://stackoverflow.com/a/52872579/3671939
 def is_port_in_use(port: int):
+    # Binding is a local kernel call. Unlike connect_ex, it never waits
+    # for a network round trip (e.g. firewalled ports)
     with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
-        return s.connect_ex(('localhost', port)) == 0
+        if os.name == 'nt':
+            # SO_REUSEADDR on Windows allows binding to ports in use
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_EXCLUSIVEADDRUSE, 1)
+        elif sys.platform.startswith('linux'):
+            # Ignore sockets in TIME_WAIT (they do not hold the port).
+            # Not on macOS/BSD, where it allows binding to 127.0.0.1
+            # while another socket listens on 0.0.0.0
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            s.bind(('localhost', port))
+        except OSError:
+            return True
+        return False
 
 
 def _find_free_port() -> int: